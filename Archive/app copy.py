@@ -1,11 +1,15 @@
 import os
-import base64
-import hashlib
+import re
+import sys
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
-from google import genai
-from openai import OpenAI
+
+# Shared helpers live in core.py at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import core
+from core import AGE_OPTIONS, TONE_OPTIONS
 
 # -------------------------------------------------
 # Page configuration
@@ -31,62 +35,16 @@ if not OPENAI_API_KEY:
     st.stop()
 
 # -------------------------------------------------
-# Clients
+# Gemini model (clients are created lazily in core.py)
 # -------------------------------------------------
-gemini_client = genai.Client(api_key=GEMINI_API_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
 TEXT_MODEL = "models/gemini-flash-latest"
 
-IMAGE_DIR = Path("generated_images")
-IMAGE_DIR.mkdir(exist_ok=True)
-
-# -------------------------------------------------
-# OpenAI image generator
-# -------------------------------------------------
-def generate_image(prompt: str):
-    """
-    Generate a child-safe illustration using OpenAI Images.
-    Images are cached locally to avoid repeat costs.
-    """
-    filename = hashlib.sha1(prompt.encode()).hexdigest()[:12] + ".png"
-    path = IMAGE_DIR / filename
-
-    if path.exists():
-        return path
-
-    try:
-        full_prompt = (
-            "Children's picture book illustration. "
-            "Soft watercolor style. Simple shapes. "
-            "Pastel colors. No text. Kid-safe. "
-            f"Scene to illustrate: {prompt}"
-        )
-
-        result = openai_client.images.generate(
-            model="gpt-image-1",
-            prompt=full_prompt,
-            size="1024x1024"
-        )
-
-        image_base64 = result.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
-
-        with open(path, "wb") as f:
-            f.write(image_bytes)
-
-        return path
-
-    except Exception as e:
-        st.error("Image generation failed (OpenAI)")
-        st.code(str(e))
-        return None
+SECTION_RE = re.compile(r"(.*?)\[Illustration idea:\s*(.*?)\]", re.DOTALL)
 
 # -------------------------------------------------
 # Styling (UNCHANGED)
 # -------------------------------------------------
-st.markdown(
-    """
+PAGE_CSS = """
     <style>
     body { background-color: #FFF8F0; }
 
@@ -132,9 +90,9 @@ st.markdown(
         border: none;
     }
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
+
+st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 # -------------------------------------------------
 # UI (UNCHANGED)
@@ -154,7 +112,7 @@ child_name = st.text_input("Child's name (optional)")
 
 age = st.selectbox(
     "Select your child's age",
-    options=list(range(3, 11))
+    options=AGE_OPTIONS
 )
 
 st.divider()
@@ -172,12 +130,7 @@ st.subheader("🎨 How should the answer feel?")
 
 tone = st.selectbox(
     "Choose the story tone",
-    options=[
-        "Gentle & soothing",
-        "Funny",
-        "Curious explorer",
-        "Simple & direct"
-    ]
+    options=TONE_OPTIONS
 )
 
 st.divider()
@@ -244,43 +197,55 @@ Do not include explanations outside this format.
 """
 
         try:
-            response = gemini_client.models.generate_content(
-                model=TEXT_MODEL,
-                contents=prompt
-            )
-
-            explanation_text = response.text
-
             st.subheader("📘 Illustrated Explanation")
 
-            sections = explanation_text.split("[Illustration idea:")
-
-            for section in sections:
-                if not section.strip():
-                    continue
-
-                parts = section.split("]")
-                text_part = parts[0].strip()
-                illustration = parts[1].strip() if len(parts) > 1 else ""
-
-                st.markdown(
-                    f"""
-                    <div class="explain-card">
-                        <div class="explain-text">{text_part}</div>
-                        <div class="illustration-text">
-                            🎨 Illustration idea: {illustration}
-                        </div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-
-                if illustration:
-                    with st.spinner("Creating illustration…"):
-                        img_path = generate_image(illustration)
-
-                    if img_path:
-                        st.image(str(img_path), use_container_width=True)
+            # Stream the explanation: each card is shown and its
+            # illustration dispatched as soon as its marker closes, so
+            # image generation overlaps with the rest of the text
+            with ThreadPoolExecutor(max_workers=core.MAX_IMAGE_WORKERS) as pool:
+                sections = []
+                explanation_text, pos = "", 0
+
+                for chunk in core.get_gemini_client().models.generate_content_stream(
+                    model=TEXT_MODEL,
+                    contents=prompt
+                ):
+                    explanation_text += chunk.text or ""
+                    for m in SECTION_RE.finditer(explanation_text, pos):
+                        pos = m.end()
+                        text_part = m.group(1).strip()
+                        illustration = m.group(2).strip()
+
+                        card = st.container()
+                        card.markdown(
+                            f"""
+                            <div class="explain-card">
+                                <div class="explain-text">{text_part}</div>
+                                <div class="illustration-text">
+                                    🎨 Illustration idea: {illustration}
+                                </div>
+                            </div>
+                            """,
+                            unsafe_allow_html=True
+                        )
+                        sections.append((
+                            card,
+                            pool.submit(core.generate_image, illustration)
+                            if illustration else None
+                        ))
+
+                for card, future in sections:
+                    if future is None:
+                        continue
+
+                    with card:
+                        try:
+                            with st.spinner("Creating illustration…"):
+                                img_path = future.result()
+                            st.image(img_path, use_container_width=True)
+                        except Exception as e:
+                            st.error("Image generation failed (OpenAI)")
+                            st.code(str(e))
 
         except Exception as e:
             st.error("Something went wrong while generating the explanation.")
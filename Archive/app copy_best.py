@@ -1,12 +1,18 @@
 import os
-import re
-import base64
-import hashlib
+import sys
 from pathlib import Path
 
 import streamlit as st
-from google import genai
-from openai import OpenAI
+
+# Shared helpers live in core.py at the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import core
+from core import (
+    AGE_OPTIONS,
+    TONE_OPTIONS,
+    clean_explanation_text,
+    iter_pages,
+)
 
 # -------------------------------------------------
 # Page configuration
@@ -32,74 +38,16 @@ if not OPENAI_API_KEY:
     st.stop()
 
 # -------------------------------------------------
-# Gemini client (NEW SDK – unchanged)
+# Gemini model (client is created lazily in core.py)
 # -------------------------------------------------
-genai_client = genai.Client(api_key=GEMINI_API_KEY)
 TEXT_MODEL = "models/gemini-flash-latest"
 
 # -------------------------------------------------
-# OpenAI client
-# -------------------------------------------------
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-IMAGE_DIR = Path("generated_images")
-IMAGE_DIR.mkdir(exist_ok=True)
-
-# -------------------------------------------------
-# FIX 2: Helper to clean explanation text
-# -------------------------------------------------
-def clean_explanation_text(text: str) -> str:
-    """
-    Remove any accidental illustration or instruction leakage
-    from explanation text before displaying to the child.
-    """
-    lines = text.splitlines()
-    cleaned = []
-
-    for line in lines:
-        l = line.lower()
-        if any(word in l for word in [
-            "illustration",
-            "illustrate",
-            "picture",
-            "image",
-            "drawing",
-            "shows",
-            "depicts"
-        ]):
-            continue
-        cleaned.append(line)
-
-    return " ".join(cleaned).strip()
-
-# -------------------------------------------------
-# OpenAI image generation (unchanged)
+# OpenAI image generation (shared, see core.py)
 # -------------------------------------------------
 def generate_image(prompt: str):
-    filename = hashlib.sha1(prompt.encode()).hexdigest()[:12] + ".png"
-    path = IMAGE_DIR / filename
-
-    if path.exists():
-        return path
-
     try:
-        full_prompt = (
-            "Children's picture book illustration. "
-            "Soft watercolor style. Simple shapes. "
-            "Pastel colors. No text. Kid-safe. "
-            f"Scene to illustrate: {prompt}"
-        )
-
-        result = openai_client.images.generate(
-            model="gpt-image-1",
-            prompt=full_prompt,
-            size="512x512"
-        )
-
-        image_bytes = base64.b64decode(result.data[0].b64_json)
-        path.write_bytes(image_bytes)
-        return path
-
+        return core.generate_image(prompt)
     except Exception as e:
         st.error("Image generation failed")
         st.code(str(e))
@@ -108,8 +56,7 @@ def generate_image(prompt: str):
 # -------------------------------------------------
 # Styling (UNCHANGED)
 # -------------------------------------------------
-st.markdown(
-    """
+PAGE_CSS = """
     <style>
     body { background-color: #FFF8F0; }
 
@@ -141,9 +88,9 @@ st.markdown(
         border: none;
     }
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
+
+st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 # -------------------------------------------------
 # UI (UNCHANGED)
@@ -157,7 +104,7 @@ st.write(
 
 st.divider()
 
-age = st.selectbox("Child's age", list(range(3, 11)))
+age = st.selectbox("Child's age", AGE_OPTIONS)
 
 question = st.text_input(
     "What is your child asking?",
@@ -166,7 +113,7 @@ question = st.text_input(
 
 tone = st.selectbox(
     "Choose the story tone",
-    ["Gentle & soothing", "Funny", "Curious explorer", "Simple & direct"]
+    TONE_OPTIONS
 )
 
 st.divider()
@@ -177,6 +124,7 @@ st.divider()
 if "pages" not in st.session_state:
     st.session_state.pages = []
     st.session_state.page_index = 0
+    st.session_state.page_images = {}
 
 # -------------------------------------------------
 # Generate story
@@ -224,7 +172,7 @@ Do not deviate from this format.
 """
 
         try:
-            response = genai_client.models.generate_content(
+            response = core.get_gemini_client().models.generate_content(
                 model=TEXT_MODEL,
                 contents=prompt
             )
@@ -232,23 +180,23 @@ Do not deviate from this format.
             raw = response.text
 
             pages = []
-            page_blocks = re.findall(
-                r"<PAGE>\s*<TEXT>(.*?)</TEXT>\s*<IMAGE>(.*?)</IMAGE>",
-                raw,
-                re.DOTALL | re.IGNORECASE
-            )
-
-            for text, image in page_blocks:
-                pages.append({
-                    "text": text.strip(),
-                    "illustration": image.strip()
-                })
+            for text, image, _ in iter_pages(raw):
+                pages.append({"text": text, "illustration": image})
 
             if not pages:
                 st.error("Story format error. Raw output below:")
                 st.code(raw)
             else:
+                # Warm every page's illustration at once so paging
+                # never waits on the network
+                with st.spinner("Creating illustrations…"):
+                    paths = core.generate_images(
+                        [page["illustration"] for page in pages]
+                    )
                 st.session_state.pages = pages
+                st.session_state.page_images = {
+                    i: path for i, path in enumerate(paths) if path
+                }
                 st.rerun()
 
         except Exception as e:
@@ -259,7 +207,8 @@ Do not deviate from this format.
 # Render storybook pages
 # -------------------------------------------------
 if st.session_state.pages:
-    page = st.session_state.pages[st.session_state.page_index]
+    idx = st.session_state.page_index
+    page = st.session_state.pages[idx]
 
     col_text, col_img = st.columns([1, 1])
 
@@ -279,8 +228,14 @@ if st.session_state.pages:
         )
 
     with col_img:
-        with st.spinner("Creating illustration…"):
-            img_path = generate_image(page["illustration"])
+        # Resolve each page's image once; Next/Previous reruns then
+        # only need a session lookup
+        if idx not in st.session_state.page_images:
+            with st.spinner("Creating illustration…"):
+                img_path = generate_image(page["illustration"])
+            if img_path:
+                st.session_state.page_images[idx] = img_path
+        img_path = st.session_state.page_images.get(idx)
         if img_path:
             st.image(str(img_path), use_container_width=True)
 
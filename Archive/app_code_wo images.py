@@ -1,4 +1,5 @@
 import os
+import re
 import streamlit as st
 from google import genai
 
@@ -31,6 +32,8 @@ if not API_KEY:
 client = genai.Client(api_key=API_KEY)
 MODEL_ID = "models/gemini-flash-latest"
 
+SECTION_RE = re.compile(r"(.*?)\[Illustration idea:\s*(.*?)\]", re.DOTALL)
+
 # -------------------------------------------------
 # Styling (clean, child-friendly explainer look)
 # -------------------------------------------------
@@ -178,16 +181,10 @@ Do not add anything else.
 
             st.subheader("📘 Illustrated Explanation")
 
-            # Split sections using illustration markers
-            sections = explanation_text.split("[Illustration idea:")
-
-            for section in sections:
-                if not section.strip():
-                    continue
-
-                parts = section.split("]")
-                text_part = parts[0].strip()
-                illustration = parts[1].strip() if len(parts) > 1 else ""
+            # Each section is its text followed by its illustration marker
+            for m in SECTION_RE.finditer(explanation_text):
+                text_part = m.group(1).strip()
+                illustration = m.group(2).strip()
 
                 st.markdown(
                     f"""
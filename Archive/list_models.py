@@ -1,11 +1,30 @@
-import google.generativeai as genai
+import json
 import os
+import sys
+import time
+from pathlib import Path
 
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+CACHE_FILE = Path.home() / ".cache" / "gaim" / "models.json"
+CACHE_TTL = 24 * 60 * 60
 
-models = genai.list_models()
+# Model metadata rarely changes, so reuse a recent listing from disk
+if CACHE_FILE.exists() and time.time() - CACHE_FILE.stat().st_mtime < CACHE_TTL:
+    models = json.loads(CACHE_FILE.read_text())
+else:
+    import google.generativeai as genai
 
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    models = [
+        {"name": m.name, "supports": list(m.supported_generation_methods)}
+        for m in genai.list_models()
+    ]
+    CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    CACHE_FILE.write_text(json.dumps(models))
+
+lines = []
 for m in models:
-    print("MODEL:", m.name)
-    print("  supports:", m.supported_generation_methods)
-    print("-----")
+    lines.append(f"MODEL: {m['name']}")
+    lines.append(f"  supports: {m['supports']}")
+    lines.append("-----")
+
+sys.stdout.write("\n".join(lines) + "\n")
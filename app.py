@@ -1,17 +1,31 @@
 import os
-import re
-import json
-import base64
 import hashlib
-import textwrap
 from pathlib import Path
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
+import orjson
+import pybase64
 import streamlit as st
-from google import genai
-from openai import OpenAI
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+from core import (
+    AGE_OPTIONS,
+    GEMINI_API_KEY,
+    MAX_IMAGE_WORKERS,
+    OPENAI_API_KEY,
+    TONE_OPTIONS,
+    clean_explanation_text,
+    generate_image,
+    get_font,
+    get_gemini_client,
+    get_openai_client,
+    image_url,
+    iter_pages,
+    pixel_wrap,
+)
 
 # -------------------------------------------------
 # Page configuration
@@ -25,26 +39,35 @@ st.set_page_config(
 # -------------------------------------------------
 # API keys
 # -------------------------------------------------
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-
 if not GEMINI_API_KEY or not OPENAI_API_KEY:
     st.error("Missing API keys.")
     st.stop()
 
 # -------------------------------------------------
-# Clients
+# Models
 # -------------------------------------------------
-genai_client = genai.Client(api_key=GEMINI_API_KEY)
 TEXT_MODEL = "models/gemini-flash-latest"
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 256
+SIMILAR_QUESTION_THRESHOLD = 0.92
+
+PROMPT_TEMPLATE = """
+Explain for a child.
+
+Question: {question}
+Age: {age}
+Tone: {tone}
+
+Create 4–6 pages.
+Each page:
+<PAGE>
+<TEXT>2–3 sentences</TEXT>
+<IMAGE>Describe one picture</IMAGE>
+"""
 
 # -------------------------------------------------
 # Storage
 # -------------------------------------------------
-IMAGE_DIR = Path("generated_images")
-IMAGE_DIR.mkdir(exist_ok=True)
-
 LIBRARY_DIR = Path("library")
 LIBRARY_DIR.mkdir(exist_ok=True)
 LIBRARY_FILE = LIBRARY_DIR / "books.json"
@@ -55,18 +78,64 @@ if not LIBRARY_FILE.exists():
 # -------------------------------------------------
 # Helpers
 # -------------------------------------------------
-def clean_explanation_text(text: str) -> str:
-    return " ".join(
-        line for line in text.splitlines()
-        if not any(w in line.lower() for w in [
-            "illustration", "illustrate", "picture",
-            "image", "drawing", "shows", "depicts"
-        ])
-    ).strip()
-
 def book_key(question, age, tone):
+    # Stays SHA-1: saved books are matched on this exact key
     return hashlib.sha1(f"{question}|{age}|{tone}".encode()).hexdigest()
 
+@st.cache_data(show_spinner=False)
+def embed_question(question: str) -> list[float]:
+    response = get_openai_client().embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=question,
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return response.data[0].embedding
+
+def encode_embedding(embedding) -> str:
+    # Base64 float32 keeps each vector on one line of books.json
+    # instead of one indented number per line
+    return pybase64.b64encode(
+        np.asarray(embedding, dtype=np.float32).tobytes()
+    ).decode()
+
+def decode_embedding(value):
+    return np.frombuffer(pybase64.b64decode(value), dtype=np.float32)
+
+def find_similar_book(library, embedding, age, tone):
+    # Reuse a saved book whose question means the same thing
+    # ("why is the sea salty?" / "why is ocean water salty?")
+    query = np.asarray(embedding, dtype=np.float32)
+    if not query.any():
+        return None
+
+    candidates, vectors = [], []
+    for b in library:
+        if not b.get("embedding") or b.get("age") != age or b.get("tone") != tone:
+            continue
+        try:
+            vector = decode_embedding(b["embedding"])
+        except (TypeError, ValueError):
+            continue
+        # Vectors from another model or dimension setting aren't comparable,
+        # and a zero or non-finite one would score nan and win argmax
+        if vector.shape != query.shape:
+            continue
+        if not vector.any() or not np.isfinite(vector).all():
+            continue
+        candidates.append(b)
+        vectors.append(vector)
+    if not candidates:
+        return None
+
+    vectors = np.stack(vectors)
+    scores = vectors @ query / (
+        np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    )
+    best = int(scores.argmax())
+    if scores[best] < SIMILAR_QUESTION_THRESHOLD:
+        return None
+    return candidates[best]
+
 def is_valid_book(book: dict) -> bool:
     if not book.get("pages"):
         return False
@@ -78,92 +147,112 @@ def is_valid_book(book: dict) -> bool:
     return True
 
 def load_library():
+    # Reuse this session's validated copy until books.json changes, so
+    # reruns skip the parse and the per-image exists() checks
     try:
-        raw = json.loads(LIBRARY_FILE.read_text())
+        mtime = LIBRARY_FILE.stat().st_mtime_ns
+        if st.session_state.get("_lib_mtime") == mtime:
+            return st.session_state["_lib_cache"]
+        raw = orjson.loads(LIBRARY_FILE.read_bytes())
     except Exception:
         return []
 
     # 🔒 AUTO-CLEAN invalid books
     cleaned = [b for b in raw if is_valid_book(b)]
 
-    # Persist cleanup if needed
+    # Persist cleanup if needed. Only our own write moves the cached
+    # mtime on; re-statting otherwise could record another session's
+    # newer file against the list parsed from the old one
     if len(cleaned) != len(raw):
         save_library(cleaned)
+        mtime = LIBRARY_FILE.stat().st_mtime_ns
 
+    st.session_state["_lib_mtime"] = mtime
+    st.session_state["_lib_cache"] = cleaned
     return cleaned
 
 def save_library(lib):
-    LIBRARY_FILE.write_text(json.dumps(lib, indent=2))
+    LIBRARY_FILE.write_bytes(orjson.dumps(lib, option=orjson.OPT_INDENT_2))
 
-def load_book_into_state(book):
+def set_current_book(book):
     st.session_state.pages = book["pages"]
     st.session_state.page_index = 0
+    st.session_state.pdf_bytes = None
+
+def load_book_into_state(book):
+    set_current_book(book)
     st.rerun()
 
 # -------------------------------------------------
-# Image generation (filesystem cache)
+# Story text (memoized per question/age/tone)
 # -------------------------------------------------
-def generate_image(prompt: str) -> str:
-    filename = hashlib.sha1(prompt.encode()).hexdigest()[:12] + ".png"
-    path = IMAGE_DIR / filename
-
-    if path.exists() and path.stat().st_size > 0:
-        return str(path)
-
-    result = openai_client.images.generate(
-        model="gpt-image-1",
-        prompt=(
-            "Children's picture book illustration. "
-            "Soft watercolor style. Pastel colors. No text. "
-            f"Scene: {prompt}"
-        ),
-        size="1024x1024"
-    )
-
-    path.write_bytes(base64.b64decode(result.data[0].b64_json))
-    return str(path)
+# Streams the story and calls _on_page(text, image) as each <PAGE> block
+# closes. Only runs on a cache miss; the leading underscore keeps the
+# callback out of the cache key. Persisted to disk so a server restart
+# doesn't forget stories that were already paid for.
+@st.cache_data(persist="disk", show_spinner=False)
+def generate_story_text(question: str, age: int, tone: str, _on_page=None) -> str:
+    prompt = PROMPT_TEMPLATE.format(question=question, age=age, tone=tone)
+
+    raw, pos = "", 0
+    for chunk in get_gemini_client().models.generate_content_stream(
+        model=TEXT_MODEL,
+        contents=prompt
+    ):
+        raw += chunk.text or ""
+        for text, img_desc, pos in iter_pages(raw, pos):
+            if _on_page:
+                _on_page(text, img_desc)
+    return raw
 
 # -------------------------------------------------
 # PDF builder
 # -------------------------------------------------
-def build_pdf(pages):
+# Cached on the (text, image_path) pairs, so preparing the same book
+# again reuses the finished PDF. Bounded, since each session also keeps
+# its own copy in st.session_state.pdf_bytes
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_pdf_bytes(pages: tuple) -> bytes:
     A4_W, A4_H = 1240, 1754
     margin = 80
     image_area_h = int(A4_H * 0.5)
     text_start_y = image_area_h + margin
 
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", 32)
-    except Exception:
-        font = ImageFont.load_default()
-
-    images = []
+    font = get_font(32)
+    bbox = font.getbbox("Ay")
+    line_h = (bbox[3] - bbox[1]) + 14
 
-    for page in pages:
+    def render_page(page):
+        page_text, image_path = page
         canvas = Image.new("RGB", (A4_W, A4_H), "white")
         draw = ImageDraw.Draw(canvas)
 
-        ill = Image.open(page["image_path"]).convert("RGB")
+        ill = Image.open(image_path).convert("RGB")
         ill.thumbnail((A4_W - 2 * margin, image_area_h), Image.LANCZOS)
         canvas.paste(ill, ((A4_W - ill.width) // 2, margin))
 
-        text = clean_explanation_text(page["text"])
-        wrapped = textwrap.wrap(text, width=36)
-
-        bbox = font.getbbox("Ay")
-        line_h = (bbox[3] - bbox[1]) + 14
+        text = clean_explanation_text(page_text)
+        wrapped = pixel_wrap(text, A4_W - 2 * margin, 32)
 
         y = text_start_y
         for line in wrapped:
             draw.text((margin, y), line, fill=(40, 40, 40), font=font)
             y += line_h
 
-        images.append(canvas)
+        return canvas
 
+    # Pillow releases the GIL while decoding and resampling, so pages
+    # render in parallel. Each window of pages is appended to the PDF
+    # and dropped as soon as it is drawn, so at most `workers` full-size
+    # canvases are alive instead of the whole book.
+    workers = min(len(pages), os.cpu_count() or 1)
     buf = BytesIO()
-    images[0].save(buf, format="PDF", save_all=True, append_images=images[1:])
-    buf.seek(0)
-    return buf
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(pages), workers):
+            for canvas in pool.map(render_page, pages[start:start + workers]):
+                canvas.save(buf, format="PDF", append=buf.tell() > 0)
+
+    return buf.getvalue()
 
 # -------------------------------------------------
 # UI
@@ -171,11 +260,11 @@ def build_pdf(pages):
 st.title("🌙 A Thousand Whys Before Bedtime")
 st.divider()
 
-age = st.selectbox("Child's age", list(range(3, 11)))
+age = st.selectbox("Child's age", AGE_OPTIONS)
 question = st.text_input("What is your child asking?")
 tone = st.selectbox(
     "Choose the story tone",
-    ["Gentle & soothing", "Funny", "Curious explorer", "Simple & direct"]
+    TONE_OPTIONS
 )
 
 # -------------------------------------------------
@@ -185,6 +274,9 @@ if "pages" not in st.session_state:
     st.session_state.pages = []
     st.session_state.page_index = 0
 
+if "pdf_bytes" not in st.session_state:
+    st.session_state.pdf_bytes = None
+
 library = load_library()
 
 # -------------------------------------------------
@@ -193,11 +285,21 @@ library = load_library()
 with st.sidebar:
     st.subheader("📚 Saved Books")
     titles = [b["title"] for b in library]
-    choice = st.selectbox("Open a saved book", ["—"] + titles)
 
-    if choice != "—":
-        book = next(b for b in library if b["title"] == choice)
-        load_book_into_state(book)
+    # Opened from the change callback, so picking a book loads it once
+    # instead of reloading (and rerunning) on every later rerun
+    def open_saved_book():
+        choice = st.session_state.saved_book
+        book = next((b for b in library if b["title"] == choice), None)
+        if book:
+            set_current_book(book)
+
+    st.selectbox(
+        "Open a saved book",
+        ["—"] + titles,
+        key="saved_book",
+        on_change=open_saved_book
+    )
 
 # -------------------------------------------------
 # Generate book
@@ -209,51 +311,60 @@ if st.button("🌟 Explain this question"):
         key = book_key(question, age, tone)
         existing = next((b for b in library if b["key"] == key), None)
 
+        # Semantic lookup is best-effort; a failed embedding call just
+        # falls through to generating a new book
+        if existing is None:
+            try:
+                embedding = embed_question(question)
+            except Exception:
+                embedding = None
+
+            if embedding:
+                existing = find_similar_book(library, embedding, age, tone)
+
+        # A saved book never reaches Gemini or the image API. Stop here
+        # explicitly rather than relying on the rerun inside the loader
         if existing:
             load_book_into_state(existing)
+            st.stop()
 
-        prompt = f"""
-Explain for a child.
-
-Question: {question}
-Age: {age}
-Tone: {tone}
+        # Image calls are network-bound, so each page's illustration is
+        # dispatched the moment its block arrives from the text stream
+        with st.spinner("Creating book…"), ThreadPoolExecutor(
+            max_workers=MAX_IMAGE_WORKERS
+        ) as pool:
+            started = []
 
-Create 4–6 pages.
-Each page:
-<PAGE>
-<TEXT>2–3 sentences</TEXT>
-<IMAGE>Describe one picture</IMAGE>
-"""
+            def start_page(text, img_desc):
+                started.append((text, pool.submit(generate_image, img_desc)))
 
-        response = genai_client.models.generate_content(
-            model=TEXT_MODEL,
-            contents=prompt
-        )
+            raw = generate_story_text(question, age, tone, _on_page=start_page)
 
-        blocks = re.findall(
-            r"<PAGE>\s*<TEXT>(.*?)</TEXT>\s*<IMAGE>(.*?)</IMAGE>",
-            response.text,
-            re.DOTALL | re.IGNORECASE
-        )
+            # Cached text is returned without streaming any pages
+            if not started:
+                for text, img_desc, _ in iter_pages(raw):
+                    start_page(text, img_desc)
 
-        if not blocks:
-            st.error("Could not generate a valid book. Please try again.")
-            st.stop()
+            if not started:
+                # Evict only this malformed response; a bare clear() would
+                # also wipe every other story persisted to disk
+                generate_story_text.clear(question, age, tone)
+                st.error("Could not generate a valid book. Please try again.")
+                st.stop()
 
-        pages = []
-        with st.spinner("Creating book…"):
-            for text, img_desc in blocks:
-                pages.append({
-                    "text": text.strip(),
-                    "image_path": generate_image(img_desc.strip())
-                })
+            pages = [
+                {"text": text, "image_path": future.result()}
+                for text, future in started
+            ]
 
         # 🔒 SAVE ONLY IF VALID
         if pages:
             book = {
                 "key": key,
                 "title": question[:60],
+                "age": age,
+                "tone": tone,
+                "embedding": encode_embedding(embedding) if embedding else None,
                 "created_at": datetime.utcnow().isoformat(),
                 "pages": pages
             }
@@ -265,21 +376,56 @@ Each page:
 # Render book
 # -------------------------------------------------
 if st.session_state.pages:
-    page = st.session_state.pages[st.session_state.page_index]
+    pages = st.session_state.pages
+    index = st.session_state.page_index
+    page = pages[index]
 
     col1, col2 = st.columns([1, 1])
     with col1:
         st.markdown(clean_explanation_text(page["text"]))
     with col2:
-        st.image(page["image_path"], use_container_width=True)
+        # Served from its static URL so it shares the browser cache
+        # with the prefetch hints below
+        url = image_url(page["image_path"])
+        if url:
+            st.markdown(
+                f'<img src="{url}" style="width:100%">',
+                unsafe_allow_html=True
+            )
+        else:
+            st.image(page["image_path"], use_container_width=True)
+
+    # Let the browser fetch the neighbouring pages' pictures while idle,
+    # so Previous/Next show them instantly
+    neighbour_urls = [
+        image_url(pages[i]["image_path"])
+        for i in (index - 1, index + 1)
+        if 0 <= i < len(pages)
+    ]
+    prefetch = "".join(
+        f'<link rel="prefetch" as="image" href="{u}">'
+        for u in neighbour_urls if u
+    )
+    if prefetch:
+        st.markdown(prefetch, unsafe_allow_html=True)
 
     st.divider()
 
+    # Buttons update the index in their callbacks, which run before the
+    # rerun the click already triggers, so no second rerun is needed
+    def prev_page():
+        st.session_state.page_index -= 1
+
+    def next_page():
+        st.session_state.page_index += 1
+
     c1, c2, c3 = st.columns([1, 2, 1])
     with c1:
-        if st.button("⬅ Previous", disabled=st.session_state.page_index == 0):
-            st.session_state.page_index -= 1
-            st.rerun()
+        st.button(
+            "⬅ Previous",
+            disabled=st.session_state.page_index == 0,
+            on_click=prev_page
+        )
 
     with c2:
         st.caption(
@@ -287,20 +433,28 @@ if st.session_state.pages:
         )
 
     with c3:
-        if st.button(
+        st.button(
             "Next ➡",
-            disabled=st.session_state.page_index == len(st.session_state.pages) - 1
-        ):
-            st.session_state.page_index += 1
-            st.rerun()
-
-    pdf = build_pdf(st.session_state.pages)
-    st.download_button(
-        "📘 Download this book (PDF)",
-        data=pdf,
-        file_name="my_story_book.pdf",
-        mime="application/pdf"
-    )
+            disabled=st.session_state.page_index == len(st.session_state.pages) - 1,
+            on_click=next_page
+        )
+
+    # The PDF is only built on request, so page navigation never pays
+    # for rendering the whole book
+    if st.session_state.pdf_bytes is None:
+        if st.button("📘 Prepare PDF"):
+            with st.spinner("Preparing PDF…"):
+                st.session_state.pdf_bytes = build_pdf_bytes(tuple(
+                    (p["text"], p["image_path"]) for p in st.session_state.pages
+                ))
+
+    if st.session_state.pdf_bytes is not None:
+        st.download_button(
+            "📘 Download this book (PDF)",
+            data=st.session_state.pdf_bytes,
+            file_name="my_story_book.pdf",
+            mime="application/pdf"
+        )
 
 st.markdown("---")
 st.caption("💛 Built to help curious kids understand the world")
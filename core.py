@@ -0,0 +1,240 @@
+"""
+Shared helpers for the storybook apps: page parsing, text cleanup and
+cached OpenAI illustrations. Imported by app.py and the archived variants
+so the logic lives in one place.
+"""
+import os
+import re
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import pybase64
+import streamlit as st
+import xxhash
+from PIL import ImageFont
+
+# -------------------------------------------------
+# Configuration
+# -------------------------------------------------
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+# Streamlit serves app/static/ from the folder holding the main script,
+# not the working directory, so anchor the cache there
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+IMAGE_DIR = STATIC_DIR / "generated_images"
+IMAGE_DIR.mkdir(parents=True, exist_ok=True)
+# Prompt records for cached images, kept outside STATIC_DIR so they are
+# never served to the browser
+IMAGE_META_DIR = Path("image_meta")
+IMAGE_META_DIR.mkdir(exist_ok=True)
+IMAGE_SIZE = "1024x1024"
+IMAGE_QUALITY = "low"
+IMAGE_FORMAT = "jpeg"
+IMAGE_COMPRESSION = 85
+IMAGE_STYLE = (
+    "Children's picture book illustration. "
+    "Soft watercolor style. Simple shapes. "
+    "Pastel colors. No text. Kid-safe. "
+)
+MAX_IMAGE_WORKERS = 6
+
+AGE_OPTIONS = (3, 4, 5, 6, 7, 8, 9, 10)
+TONE_OPTIONS = ("Gentle & soothing", "Funny", "Curious explorer", "Simple & direct")
+
+# -------------------------------------------------
+# Parsing
+# -------------------------------------------------
+PAGE_TAGS = ("<PAGE>", "<TEXT>", "</TEXT>", "<IMAGE>", "</IMAGE>")
+# Case-insensitive like the PAGE_RE this replaced, so <page>/<Text> from
+# the model still parse
+PAGE_TAG_RES = tuple(
+    re.compile(re.escape(tag), re.IGNORECASE) for tag in PAGE_TAGS
+)
+
+FORBIDDEN_RE = re.compile(
+    r"(?:illustration|illustrate|picture|image|drawing|shows|depicts)",
+    re.IGNORECASE
+)
+
+@lru_cache(maxsize=256)
+def clean_explanation_text(text: str) -> str:
+    """
+    Remove any accidental illustration or instruction leakage
+    from explanation text before displaying to the child.
+    Memoized because every rerun and PDF export re-cleans the same pages.
+    """
+    return " ".join(
+        line for line in text.splitlines()
+        if not FORBIDDEN_RE.search(line)
+    ).strip()
+
+def iter_pages(raw: str, start: int = 0):
+    """
+    Single left-to-right scan for the page tags, in any case. Yields
+    (text, image, end) for each complete block; `end` lets a caller
+    resume from there once more text has arrived.
+    """
+    while True:
+        matches = []
+        pos = start
+        for tag_re in PAGE_TAG_RES:
+            m = tag_re.search(raw, pos)
+            if m is None:
+                return
+            matches.append(m)
+            pos = m.end()
+
+        _, text_open, text_close, image_open, image_close = matches
+        start = pos
+        yield (
+            raw[text_open.end():text_close.start()].strip(),
+            raw[image_open.end():image_close.start()].strip(),
+            start
+        )
+
+# -------------------------------------------------
+# Fonts (parsed once per process)
+# -------------------------------------------------
+@lru_cache(maxsize=4)
+def get_font(size: int = 32):
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=4096)
+def text_width(word: str, size: int = 32) -> float:
+    """Rendered width of `word` in pixels; story words repeat a lot."""
+    return get_font(size).getlength(word)
+
+def pixel_wrap(text: str, max_px: int, size: int = 32) -> list[str]:
+    """
+    Greedily pack words into lines no wider than `max_px` when drawn
+    with get_font(size). A single word wider than a line gets its own.
+    """
+    space_w = text_width(" ", size)
+    lines, cur, cur_w = [], [], 0.0
+    for word in text.split():
+        word_w = text_width(word, size)
+        if cur and cur_w + space_w + word_w > max_px:
+            lines.append(" ".join(cur))
+            cur, cur_w = [word], word_w
+        else:
+            cur_w += space_w + word_w if cur else word_w
+            cur.append(word)
+    if cur:
+        lines.append(" ".join(cur))
+    return lines
+
+# -------------------------------------------------
+# Clients (SDKs imported on first use, shared across reruns)
+# -------------------------------------------------
+@st.cache_resource(show_spinner=False)
+def get_gemini_client():
+    from google import genai
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    # One pooled HTTP/2 client shared by every image worker, so the TLS
+    # handshake is paid once per process rather than once per page
+    import httpx
+    from openai import DefaultHttpxClient, OpenAI
+    # Image renders routinely take tens of seconds, so the timeout is
+    # generous; retries cover transient 429/5xx responses
+    return OpenAI(
+        api_key=OPENAI_API_KEY,
+        timeout=120,
+        max_retries=2,
+        http_client=DefaultHttpxClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=MAX_IMAGE_WORKERS,
+                max_keepalive_connections=MAX_IMAGE_WORKERS
+            )
+        )
+    )
+
+# -------------------------------------------------
+# Image generation (filesystem cache)
+# -------------------------------------------------
+def generate_image(prompt: str) -> str:
+    """
+    Generate a child-safe illustration using OpenAI Images.
+    Images are cached locally to avoid repeat costs. The cache key is
+    the scene prompt alone, not the styled request, so every app asking
+    for the same scene shares one file.
+    """
+    filename = f"{xxhash.xxh3_64_hexdigest(prompt.encode())[:12]}.{IMAGE_FORMAT}"
+    path = IMAGE_DIR / filename
+
+    if path.exists() and path.stat().st_size > 0:
+        return str(path)
+
+    request = {
+        "model": "gpt-image-1",
+        "prompt": f"{IMAGE_STYLE}Scene: {prompt}",
+        "size": IMAGE_SIZE,
+        "quality": IMAGE_QUALITY,
+        "output_format": IMAGE_FORMAT,
+        "output_compression": IMAGE_COMPRESSION,
+    }
+    result = get_openai_client().images.generate(**request)
+
+    # Write to a private temp file and rename it into place, so an
+    # interrupted write never leaves a truncated image behind as a cache hit
+    fd, tmp = tempfile.mkstemp(dir=IMAGE_DIR, suffix=f".{IMAGE_FORMAT}.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pybase64.b64decode(result.data[0].b64_json, validate=False))
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    # Record exactly what was sent, for debugging the cache. Best-effort:
+    # the image is already cached, so a failed write must not fail it
+    try:
+        (IMAGE_META_DIR / f"{path.stem}.json").write_bytes(
+            orjson.dumps({"scene": prompt, **request}, option=orjson.OPT_INDENT_2)
+        )
+    except OSError:
+        pass
+    return str(path)
+
+def image_url(image_path: str):
+    """
+    URL Streamlit's static serving exposes for an image under STATIC_DIR,
+    or None for files kept elsewhere (e.g. books saved before the move)
+    and whenever static serving is off. Streamlit switches it off at
+    startup once the folder passes 1 GB.
+    """
+    if not st.get_option("server.enableStaticServing"):
+        return None
+    path = Path(image_path).resolve()
+    if not path.is_relative_to(STATIC_DIR):
+        return None
+    return "app/static/" + path.relative_to(STATIC_DIR).as_posix()
+
+def generate_images(prompts: list[str]) -> list:
+    """
+    Generate several illustrations concurrently over the shared client.
+    Paths come back in prompt order; a prompt that fails yields None so
+    the caller can retry it on its own.
+    """
+    def _safe(prompt):
+        try:
+            return generate_image(prompt)
+        except Exception:
+            return None
+
+    if not prompts:
+        return []
+    with ThreadPoolExecutor(
+        max_workers=min(len(prompts), MAX_IMAGE_WORKERS)
+    ) as pool:
+        return list(pool.map(_safe, prompts))